@@ -0,0 +1,6 @@
+-- upgrade_comments_index.sql
+-- 为已有的 comments 表增加按博客分页读取评论用的索引
+
+use pyblog;
+
+alter table comments add key `idx_blog_id_created_at` (`blog_id`, `created_at`);
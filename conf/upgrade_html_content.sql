@@ -0,0 +1,6 @@
+-- upgrade_html_content.sql
+-- 为已有的 blogs 表增加预渲染的 html_content 字段, 执行后运行 www/backfill.py 填充旧数据
+
+use pyblog;
+
+alter table blogs add column `html_content` mediumtext not null after `content`;
@@ -19,6 +19,8 @@ def build(c):
     excludes = ['test', '.*', '*.pyc', '*.pyo']
     c.local('rm -rf dist/%s' % _TAR_FILE)
     with c.cd('www'):
+        # 生成带摘要的文件名、预压缩文件和 manifest
+        c.local('python3 assets.py')
         cmd = ['tar', '--dereference', '-czvf', '../dist/%s' % _TAR_FILE]
         cmd.extend(['--exclude=\'%s\'' % ex for ex in excludes])
         cmd.extend(includes)
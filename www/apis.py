@@ -7,6 +7,8 @@ __author__ = 'Victor Song'
 JSON API definition
 '''
 
+import base64, json
+
 class APIError(Exception):
     '''
     The base APIError which contains error(required), data(optional) and message(optional).
@@ -57,4 +59,53 @@ class Page(object):
     def __str__(self):
         return 'item_count: %s, page_count: %s, page_index: %s, page_size: %s, offset: %s, limit: %s' % (self.item_count, self.page_count, self.page_index, self.page_size, self.offset, self.limit)
     
-    __repr__ = __str__
\ No newline at end of file
+    __repr__ = __str__
+
+class Cursor(object):
+    '''
+    Keyset pagination. The cursor is an opaque string built from the (created_at, id) of the last item of previous page.
+    '''
+    def __init__(self, cursor: str = '', page_size: int = 10):
+        self.cursor = cursor
+        self.page_size = page_size
+        self.limit = page_size + 1
+        self.seek = self.decode(cursor) if cursor else None
+        self.next_cursor = None
+        self.has_next = False
+
+    @staticmethod
+    def encode(value, pk) -> str:
+        return base64.urlsafe_b64encode(json.dumps([value, pk]).encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def decode(cursor: str) -> tuple:
+        try:
+            value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        except Exception:
+            raise APIValueError('cursor', 'invalid cursor')
+        # The values go into SQL args, accept only a number and a string primary key
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not isinstance(pk, str):
+            raise APIValueError('cursor', 'invalid cursor')
+        return value, pk
+
+    def trim(self, items: list, key: str = 'created_at') -> list:
+        '''
+        Cut the extra item fetched by limit and generate the cursor of next page.
+        '''
+        self.has_next = len(items) > self.page_size
+        items = items[:self.page_size]
+        if self.has_next:
+            last = items[-1]
+            self.next_cursor = self.encode(last[key], last.id)
+        return items
+
+    def __json__(self) -> dict:
+        '''
+        Only expose what the client needs, the decoded seek values stay internal.
+        '''
+        return dict(next_cursor=self.next_cursor, has_next=self.has_next)
+
+    def __str__(self):
+        return 'cursor: %s, page_size: %s, next_cursor: %s' % (self.cursor, self.page_size, self.next_cursor)
+
+    __repr__ = __str__
@@ -8,13 +8,14 @@ Web App 的 入口
 '''
 
 import logging; logging.basicConfig(level=logging.INFO)
-import asyncio, os, json, time
-from datetime import datetime
+import asyncio, os, queue, time, hashlib
 from aiohttp import web
-from jinja2 import Environment, FileSystemLoader
-import orm
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+import orm, render, compress, assets
+from serializer import dumps
+from config import configs
 from coroweb import add_routes, add_static
-from handlers import COOKIE_NAME, cookie2user
+from handlers import COOKIE_NAME, cookie2user, page_cache
 
 def init_jinja2(app, **kw):
     logging.info('init jinja2...')
@@ -24,23 +25,39 @@ def init_jinja2(app, **kw):
         block_end_string = kw.get('block_end_string', '%}'),
         variable_start_string = kw.get('variable_start_string', '{{'),
         variable_end_string = kw.get('variable_end_string', '}}'),
-        auto_reload = kw.get('auto_reload', True)
+        auto_reload = kw.get('auto_reload', configs.debug),
+        enable_async = kw.get('enable_async', configs.templates.stream)
     )
+    if not configs.debug:
+        # 生产模式：模版编译结果缓存到文件，进程重启后不需要重新编译
+        options['bytecode_cache'] = FileSystemBytecodeCache(configs.templates.bytecode_cache)
     path = kw.get('path', None)
     if path is None:
         path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
     logging.info('set jinja template path: %s' % path)
     env = Environment(loader=FileSystemLoader(path), **options)
     filters = kw.get('filters', None)
-    if filter is not None:
+    if filters is not None:
         for name, f in filters.items():
             env.filters[name] = f
+    env.globals.update(kw.get('globals', {}))
+    if not configs.debug:
+        # 启动时加载所有模版，避免第一个请求编译模版
+        for name in env.list_templates(extensions=['html']):
+            env.get_template(name)
+        logging.info('%s templates loaded.' % len(env.cache))
     app['__templating__'] = env
 
 async def logger_factory(app, handler):
     async def logger(request: web.Request):
         logging.info('Request: %s %s' % (request.method, request.path))
-        return (await handler(request))
+        stats = app['__stats__']
+        stats['requests'] += 1
+        stats['in_flight'] += 1
+        try:
+            return (await handler(request))
+        finally:
+            stats['in_flight'] -= 1
     return logger
 
 async def data_factory(app, handler):
@@ -55,6 +72,75 @@ async def data_factory(app, handler):
         return (await handler(request))
     return parse_data
 
+# 刚写入过数据的客户端带有该 cookie，查询都读主库
+PRIMARY_COOKIE = 'pyblogrw'
+
+async def scope_factory(app, handler):
+    ''' 记录每个请求的读写状态（见 orm.request_scope）
+    配置了从库时，写入之后的 read_your_writes 秒内该客户端的查询都读主库，避免从库延迟导致看不到自己刚写入的数据
+    '''
+    async def request_scope(request: web.Request):
+        replicas = orm.has_replicas()
+        with orm.request_scope(read_primary=replicas and bool(request.cookies.get(PRIMARY_COOKIE))) as scope:
+            resp = await handler(request)
+        if replicas and scope['written'] and isinstance(resp, web.StreamResponse) and not resp.prepared:
+            resp.set_cookie(PRIMARY_COOKIE, '1', max_age=configs.db.read_your_writes, httponly=True)
+        return resp
+    return request_scope
+
+def is_page_cacheable(request: web.Request) -> bool:
+    ''' 只缓存未登录访客对指定页面的 GET 请求 '''
+    if 'GET' != request.method or request.cookies.get(COOKIE_NAME) or request.cookies.get(PRIMARY_COOKIE):
+        return False
+    path = request.path
+    return path in configs.page_cache.paths or any(map(path.startswith, configs.page_cache.prefixes))
+
+async def cache_factory(app, handler):
+    async def cache(request: web.Request):
+        if not is_page_cacheable(request):
+            return await handler(request)
+        # 压缩后的响应也会被缓存，按压缩算法区分
+        key = (request.path_qs, compress.negotiate(request.headers.get('Accept-Encoding')))
+        cached = page_cache.get(key)
+        if cached is not None:
+            body, headers = cached
+            if is_not_modified(request, headers['ETag']):
+                return not_modified(headers['ETag'])
+            return web.Response(body=body, headers=headers)
+        resp = await handler(request)
+        if type(resp) is web.Response and 200 == resp.status and isinstance(resp.body, bytes):
+            headers = dict(ETag=make_etag(resp.body))
+            for name in ('Content-Type', 'Content-Encoding', 'ETag', 'Vary'):
+                if name in resp.headers:
+                    headers[name] = resp.headers[name]
+            page_cache.set(key, (resp.body, headers))
+        return resp
+    return cache
+
+async def compress_factory(app, handler):
+    async def compress_response(request: web.Request):
+        resp = await handler(request)
+        # 304 没有响应内容，无法判断是否需要压缩，ETag 由 conditional_response 处理
+        if type(resp) is not web.Response or 200 != resp.status or 'Content-Encoding' in resp.headers:
+            return resp
+        body = resp.body
+        if not isinstance(body, bytes) or not compress.is_compressible(resp.headers.get('Content-Type')):
+            return resp
+        resp.headers['Vary'] = 'Accept-Encoding'
+        encoding = compress.negotiate(request.headers.get('Accept-Encoding'))
+        if encoding is None or not compress.should_compress(resp.headers.get('Content-Type'), len(body)):
+            return resp
+        if len(body) >= configs.compress.offload_size:
+            body = await asyncio.get_event_loop().run_in_executor(None, compress.compress, body, encoding)
+        else:
+            body = compress.compress(body, encoding)
+        resp.body = body
+        resp.headers['Content-Encoding'] = encoding
+        if 'ETag' in resp.headers:
+            resp.headers['ETag'] = compress.variant_etag(resp.headers['ETag'], encoding)
+        return resp
+    return compress_response
+
 async def auth_factory(app, handler):
     async def auth(request):
         logging.info('check user: %s %s' % (request.method, request.path))
@@ -71,6 +157,124 @@ async def auth_factory(app, handler):
     return auth
 
 
+def is_async_iterable(o):
+    return hasattr(o, '__aiter__')
+
+async def write_json_array(resp: web.StreamResponse, items, chunk_size: int = 8192):
+    ''' 把异步迭代器逐项编码成 JSON 数组写出，凑够 chunk_size 字节再发送 '''
+    buf = []
+    size = 0
+    sep = b'['
+    async for item in items:
+        data = dumps(item)
+        buf.append(sep)
+        buf.append(data)
+        sep = b','
+        size += len(data) + 1
+        if size >= chunk_size:
+            await resp.write(b''.join(buf))
+            buf = []
+            size = 0
+    buf.append(b']' if sep == b',' else b'[]')
+    await resp.write(b''.join(buf))
+
+def enable_stream_compression(request: web.Request, resp: web.StreamResponse):
+    ''' 流式响应不经过 compress_factory，在 prepare 之前开启 aiohttp 的边输出边压缩
+    aiohttp 只支持即时 gzip 压缩，流式响应不使用 br
+    '''
+    resp.headers['Vary'] = 'Accept-Encoding'
+    if compress.negotiate(request.headers.get('Accept-Encoding'), ('gzip',)):
+        resp.enable_compression(web.ContentCoding.gzip)
+
+async def stream_json(request: web.Request, r):
+    ''' 以 chunked 方式输出 JSON，r 为异步迭代器或者包含异步迭代器的 dict '''
+    resp = web.StreamResponse()
+    resp.content_type = 'application/json;charset:utf-8'
+    resp.enable_chunked_encoding()
+    enable_stream_compression(request, resp)
+    await resp.prepare(request)
+    if is_async_iterable(r):
+        await write_json_array(resp, r)
+    else:
+        await resp.write(b'{')
+        for i, (k, v) in enumerate(r.items()):
+            await resp.write((b',' if i else b'') + dumps(k) + b':')
+            if is_async_iterable(v):
+                await write_json_array(resp, v)
+            else:
+                await resp.write(dumps(v))
+        await resp.write(b'}')
+    await resp.write_eof()
+    return resp
+
+def make_etag(body: bytes) -> str:
+    ''' 根据响应内容生成强 ETag '''
+    return '"%s"' % hashlib.sha1(body).hexdigest()
+
+def weak_etag(etag: str) -> str:
+    ''' If-None-Match 使用弱比较：忽略 W/ 前缀和压缩算法后缀 '''
+    return compress.strip_etag(etag[2:] if etag.startswith('W/') else etag)
+
+def is_not_modified(request: web.Request, etag: str = None, last_modified: float = None) -> bool:
+    ''' 检查 If-None-Match / If-Modified-Since，两者都有时以 If-None-Match 为准 '''
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        tags = [weak_etag(t.strip()) for t in if_none_match.split(',')]
+        return etag is not None and ('*' in tags or weak_etag(etag) in tags)
+    if last_modified is not None and request.if_modified_since is not None:
+        return int(last_modified) <= request.if_modified_since.timestamp()
+    return False
+
+def not_modified(etag: str = None, last_modified: float = None):
+    resp = web.Response(status=304)
+    if etag is not None:
+        resp.headers['ETag'] = etag
+    if last_modified is not None:
+        resp.last_modified = last_modified
+    return resp
+
+def conditional_response(request: web.Request, body: bytes, content_type: str, etag: str = None, last_modified: float = None):
+    ''' 生成带 ETag / Last-Modified 的响应，客户端缓存仍然有效时返回 304 '''
+    etag = etag or make_etag(body)
+    if is_not_modified(request, etag, last_modified):
+        # 304 的 ETag 要与完整响应的一致，完整响应会被 compress_factory 压缩时才加上压缩算法后缀
+        encoding = compress.negotiate(request.headers.get('Accept-Encoding'))
+        if encoding is not None and compress.should_compress(content_type, len(body)):
+            etag = compress.variant_etag(etag, encoding)
+        resp = not_modified(etag, last_modified)
+        if compress.is_compressible(content_type):
+            resp.headers['Vary'] = 'Accept-Encoding'
+        return resp
+    resp = web.Response(body=body)
+    resp.content_type = content_type
+    resp.headers['ETag'] = etag
+    if last_modified is not None:
+        resp.last_modified = last_modified
+    return resp
+
+async def stream_template(request: web.Request, template, r: dict, chunk_size: int = 4096, etag: str = None):
+    ''' 使用 Jinja2 的异步模式逐段渲染模版，以 chunked 方式输出 '''
+    resp = web.StreamResponse()
+    resp.content_type = 'text/html;charset:utf-8'
+    if etag is not None:
+        resp.headers['ETag'] = etag
+    resp.enable_chunked_encoding()
+    enable_stream_compression(request, resp)
+    await resp.prepare(request)
+    buf = []
+    size = 0
+    async for s in template.generate_async(**r):
+        buf.append(s)
+        size += len(s)
+        if size >= chunk_size:
+            await resp.write(''.join(buf).encode('utf-8'))
+            buf = []
+            size = 0
+    if buf:
+        await resp.write(''.join(buf).encode('utf-8'))
+    await resp.write_eof()
+    return resp
+
 async def response_factory(app, handler):
     async def response(request: web.Request):
         logging.info('Response handler...')
@@ -87,17 +291,28 @@ async def response_factory(app, handler):
             resp = web.Response(body=r.encode('utf-8'))
             resp.content_type = 'text/html;charset=utf-8'
             return resp
+        if is_async_iterable(r):
+            return await stream_json(request, r)
         if isinstance(r, dict):
             template = r.get('__template__')
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
-                resp.content_type = 'application/json;charset:utf-8'
-                return resp
+                if any(map(is_async_iterable, r.values())):
+                    return await stream_json(request, r)
+                return conditional_response(request, dumps(r), 'application/json;charset:utf-8')
             else:
+                # handler 可以通过 __etag__ / __last_modified__ 提供由数据库记录得到的校验值，命中时不必渲染模版
+                # 这样的校验值不是由响应内容计算的，只能作为弱 ETag
+                etag = r.pop('__etag__', None)
+                etag = 'W/"%s"' % etag if etag else None
+                last_modified = r.pop('__last_modified__', None)
+                if (etag or last_modified) and is_not_modified(request, etag, last_modified):
+                    return not_modified(etag, last_modified)
                 r['__user__'] = request.__user__
-                resp = web.Response(body=app['__templating__'].get_template(template).render(**r).encode('utf-8'))
-                resp.content_type = 'text/html;charset:utf-8'
-                return resp
+                env = app['__templating__']
+                if env.is_async:
+                    return await stream_template(request, env.get_template(template), r, configs.templates.stream_chunk_size, etag)
+                body = env.get_template(template).render(**r).encode('utf-8')
+                return conditional_response(request, body, 'text/html;charset:utf-8', etag, last_modified)
         if isinstance(r, int) and r >= 100 and r < 600:
             return web.Response(r)
         if isinstance(r, tuple) and len(r) == 2:
@@ -109,28 +324,69 @@ async def response_factory(app, handler):
             return resp
     return response
 
-def datetime_filter(t):
-    delta = int(time.time() - t)
-    if delta < 60:
-        return u'1分钟前'
-    if delta < 3600:
-        return u'%s分钟前' % (delta // 60)
-    if delta < 86400:
-        return u'%s小时前' % (delta // 3600)
-    if delta < 604800:
-        return u'%s天前' % (delta // 86400)
-    dt = datetime.fromtimestamp(t)
-    return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
-
  
-def start_server():
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(orm.create_pool(loop, host='0.0.0.0', port=3306, user='www-data', password='www-data', db='pyblog'))
-    app = web.Application(middlewares=[logger_factory, auth_factory, response_factory])
-    init_jinja2(app, filters=dict(datetime=datetime_filter))
+def init_health_report(app, health):
+    ''' 定时向 supervisor 报告 worker 的状态 '''
+    async def report():
+        while True:
+            health.put(dict(pid=os.getpid(), time=time.time(), pool=orm.pool_stats(), **app['__stats__']))
+            await asyncio.sleep(configs.server.heartbeat)
+    async def start(app):
+        app['__health_task__'] = asyncio.ensure_future(report())
+    async def stop(app):
+        app['__health_task__'].cancel()
+    app.on_startup.append(start)
+    app.on_cleanup.append(stop)
+
+def init_invalidation(app, health, inbox):
+    ''' 在多个 worker 之间同步缓存：本进程删除的缓存通过 health 队列交给 supervisor 转发给其他 worker，
+    其他 worker 删除的缓存从 inbox 读取，同时清空页面缓存
+    '''
+    orm.add_evict_listener(lambda table, pk: health.put(dict(pid=os.getpid(), evict=(table, pk))))
+    def receive():
+        messages = []
+        try:
+            messages.append(inbox.get(timeout=1))
+            while True:
+                messages.append(inbox.get_nowait())
+        except queue.Empty:
+            pass
+        return messages
+    async def apply():
+        loop = asyncio.get_event_loop()
+        while True:
+            messages = await loop.run_in_executor(None, receive)
+            for table, pk in messages:
+                orm.evict_remote(table, pk)
+            if messages:
+                page_cache.clear()
+    async def start(app):
+        app['__invalidation_task__'] = asyncio.ensure_future(apply())
+    async def stop(app):
+        app['__invalidation_task__'].cancel()
+    app.on_startup.append(start)
+    app.on_cleanup.append(stop)
+
+def start_server(reuse_port: bool = False, health=None, inbox=None):
+    ''' 启动服务；由 supervisor 启动多个 worker 时使用 reuse_port 共享端口，
+    通过 health 队列报告状态和本进程删除的缓存，从 inbox 队列接收其他 worker 删除的缓存
+    '''
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(orm.create_pool(loop, **configs.db))
+    render.init_pool()
+    app = web.Application(middlewares=[logger_factory, scope_factory, cache_factory, compress_factory, auth_factory, response_factory])
+    app['__stats__'] = dict(requests=0, in_flight=0)
+    app.on_cleanup.append(render.close_pool)
+    if health is not None:
+        init_health_report(app, health)
+    if inbox is not None:
+        init_invalidation(app, health, inbox)
+    init_jinja2(app, filters=dict(datetime=render.datetime_filter), globals=dict(static_url=assets.static_url))
     add_routes(app, 'handlers')
     add_static(app)
-    web.run_app(app, host='0.0.0.0', port=9000)
-    logging.info('server start at localhost:9000...')
+    web.run_app(app, host=configs.server.host, port=configs.server.port, reuse_port=reuse_port)
+    logging.info('server start at localhost:%s...' % configs.server.port)
 
-start_server()
\ No newline at end of file
+if __name__ == '__main__':
+    start_server()
\ No newline at end of file
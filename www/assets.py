@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Victor Song'
+
+'''
+静态资源：发布时生成带内容摘要的文件名和预压缩文件，运行时据此生成 URL 和响应
+
+用法: python3 assets.py
+'''
+
+import gzip, hashlib, json, logging, os, posixpath, re, shutil
+from config import configs
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+MANIFEST_FILE = os.path.join(DIST_DIR, 'manifest.json')
+
+COMPRESS_EXTS = ('.css', '.js', '.svg', '.eot', '.ttf', '.otf', '.json', '.txt')
+
+_RE_CSS_URL = re.compile(r'url\((["\']?)([^"\')]+)\1\)')
+_RE_URL_QUERY = re.compile(r'([^?#]*)(.*)')
+
+def fingerprint(name: str, data: bytes) -> str:
+    ''' a/b.min.js ==> a/b.min.<hash>.js '''
+    root, ext = posixpath.splitext(name)
+    return '%s.%s%s' % (root, hashlib.md5(data).hexdigest()[:10], ext)
+
+def rewrite_css(name: str, data: bytes, manifest: dict) -> bytes:
+    ''' 把 CSS 中引用的相对路径替换成带摘要的文件名 '''
+    base = posixpath.dirname(name)
+    def replace(m):
+        url = m.group(2)
+        if ':' in url or url.startswith('/'):
+            return m.group(0)
+        path, query = _RE_URL_QUERY.match(url).groups()
+        target = posixpath.normpath(posixpath.join(base, path))
+        if target not in manifest:
+            return m.group(0)
+        hashed = posixpath.relpath(manifest[target], base)
+        return 'url(%s%s%s%s)' % (m.group(1), hashed, query, m.group(1))
+    return _RE_CSS_URL.sub(replace, data.decode('utf-8')).encode('utf-8')
+
+def write(name: str, data: bytes):
+    ''' 写入 dist 目录，可以压缩的文件同时生成 .gz 和 .br '''
+    path = os.path.join(DIST_DIR, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    if name.endswith(COMPRESS_EXTS):
+        with open(path + '.gz', 'wb') as f:
+            f.write(gzip.compress(data, 9))
+        if brotli is not None:
+            with open(path + '.br', 'wb') as f:
+                f.write(brotli.compress(data, quality=11))
+
+def build():
+    ''' 生成 static/dist 目录和 manifest.json '''
+    shutil.rmtree(DIST_DIR, ignore_errors=True)
+    names = []
+    for root, dirs, files in os.walk(STATIC_DIR):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != DIST_DIR]
+        for f in files:
+            if not f.startswith('.'):
+                names.append(os.path.relpath(os.path.join(root, f), STATIC_DIR).replace(os.sep, '/'))
+    # CSS 最后处理，这样其中引用的字体、图片已经有了带摘要的文件名
+    names.sort(key=lambda n: (n.endswith('.css'), n))
+    manifest = dict()
+    for name in names:
+        with open(os.path.join(STATIC_DIR, name), 'rb') as f:
+            data = f.read()
+        if name.endswith('.css'):
+            data = rewrite_css(name, data, manifest)
+        manifest[name] = fingerprint(name, data)
+        write(name, data)
+        write(manifest[name], data)
+        logging.info('build asset: %s ==> %s' % (name, manifest[name]))
+    with open(MANIFEST_FILE, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    logging.info('%s assets built.' % len(manifest))
+    return manifest
+
+def load_manifest() -> dict:
+    if not os.path.exists(MANIFEST_FILE):
+        return dict()
+    with open(MANIFEST_FILE) as f:
+        return json.load(f)
+
+# 原文件名 ==> 带摘要的文件名，没有执行过 build 时为空，直接使用 static 目录
+manifest = load_manifest()
+_fingerprinted = set(manifest.values())
+# 静态资源的版本，重新 build 后页面中的 URL 会变化，由 handler 提供 ETag 的页面需要用到
+version = hashlib.md5(json.dumps(manifest, sort_keys=True).encode('utf-8')).hexdigest()[:10]
+
+def static_root() -> str:
+    return DIST_DIR if manifest else STATIC_DIR
+
+def static_url(name: str) -> str:
+    ''' 模版中使用: {{ static_url('js/vue.min.js') }} '''
+    return '/static/%s' % manifest.get(name, name)
+
+def cache_control(name: str) -> str:
+    ''' 带摘要的文件内容不会变化，可以永久缓存 '''
+    if name in _fingerprinted:
+        return 'public, max-age=%s, immutable' % configs.static.max_age
+    return 'public, max-age=%s' % configs.static.default_max_age
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    build()
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Victor Song'
+
+'''
+为已有的博客生成 html_content（先执行 conf/upgrade_html_content.sql）
+
+用法: python3 backfill.py [--all]
+'''
+
+import logging; logging.basicConfig(level=logging.INFO)
+import asyncio, sys
+import orm
+from config import configs
+from models import Blog
+
+async def backfill(loop, rebuild: bool = False):
+    await orm.create_pool(loop, **configs.db)
+    where = None if rebuild else "html_content is null or html_content=''"
+    count = 0
+    async for blog in Blog.iterate(where, fields=Blog.__fields__):
+        await blog.update()
+        count += 1
+        logging.info('backfill html_content for blog: %s' % blog.id)
+    logging.info('%s blogs updated.' % count)
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(backfill(loop, '--all' in sys.argv[1:]))
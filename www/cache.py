@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Victor Song'
+
+'''
+进程内缓存
+'''
+
+import time
+from collections import OrderedDict
+
+class LRUCache(object):
+    ''' 有容量上限的 LRU 缓存，超出容量时淘汰最久未使用的条目
+    Attributes:
+        maxsize: 最多保存的条目数
+        ttl: 条目的存活秒数，None 表示不过期
+    '''
+    def __init__(self, maxsize: int = 128, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        ''' 读取缓存，命中时移到队尾 '''
+        try:
+            value, expires = self._data[key]
+        except KeyError:
+            return default
+        if expires is not None and expires < time.time():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        ''' 写入缓存，ttl 为 None 时使用默认的存活时间 '''
+        ttl = self.ttl if ttl is None else ttl
+        self._data[key] = (value, None if ttl is None else time.time() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        ''' 删除并返回缓存 '''
+        item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def keys(self):
+        return list(self._data.keys())
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._data)
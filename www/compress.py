@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Victor Song'
+
+'''
+响应压缩，安装了 brotli 时支持 br
+'''
+
+import gzip
+from config import configs
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'image/svg+xml')
+
+def supported_encodings():
+    ''' 按优先级排列的压缩算法 '''
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+def negotiate(accept_encoding: str, encodings: tuple = None):
+    ''' 根据 Accept-Encoding 从 encodings（默认为 supported_encodings()）中选择压缩算法，不压缩时返回 None '''
+    if not accept_encoding:
+        return None
+    accepted = dict()
+    for item in accept_encoding.split(','):
+        parts = item.strip().split(';')
+        q = 1.0
+        for p in parts[1:]:
+            p = p.strip()
+            if p.startswith('q='):
+                try:
+                    q = float(p[2:])
+                except ValueError:
+                    q = 0.0
+        accepted[parts[0].strip().lower()] = q
+    for encoding in encodings or supported_encodings():
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+def is_compressible(content_type: str) -> bool:
+    return bool(content_type) and content_type.startswith(COMPRESSIBLE_TYPES)
+
+def should_compress(content_type: str, size: int) -> bool:
+    ''' 完整响应是否会被压缩：类型可以压缩并且不小于 threshold '''
+    return is_compressible(content_type) and size >= configs.compress.threshold
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if 'br' == encoding:
+        return brotli.compress(body, quality=configs.compress.brotli_quality)
+    return gzip.compress(body, configs.compress.gzip_level)
+
+def variant_etag(etag: str, encoding: str) -> str:
+    ''' 压缩后的内容与原内容字节不同，强 ETag 需要加上压缩算法后缀，弱 ETag 不需要 '''
+    if etag.startswith('W/'):
+        return etag
+    return '%s-%s"' % (etag[:-1], encoding)
+
+def strip_etag(etag: str) -> str:
+    ''' 去掉 variant_etag 加上的后缀 '''
+    for encoding in supported_encodings():
+        suffix = '-%s"' % encoding
+        if etag.endswith(suffix):
+            return etag[:-len(suffix)] + '"'
+    return etag
@@ -9,14 +9,75 @@ Default configurations.
 
 configs = {
     'debug': True,
+    'server': {
+        'host': '0.0.0.0',
+        'port': 9000,
+        # supervisor.py 启动的 worker 数量，0 表示 CPU 核数
+        'workers': 0,
+        # worker 报告状态的间隔，超过 heartbeat_timeout 秒没有报告的 worker 会被重启
+        'heartbeat': 5,
+        'heartbeat_timeout': 30
+    },
     'db': {
         'host': '127.0.0.1',
         'port': 3306,
         'user': 'www-data',
         'password': 'www-data',
         'db': 'pyblog',
+        # 连接池大小、建立连接和从连接池获取连接的超时时间（秒）、连接的最长使用时间（秒，-1 表示不限制）
+        'minsize': 1,
+        'maxsize': 10,
+        'connect_timeout': 10,
+        'acquire_timeout': 5,
+        'pool_recycle': 3600,
+        # 只读从库，每一项中未指定的参数与主库相同，如 [{'host': '10.0.0.2'}]
+        'replicas': [],
+        # 从库选择策略：round_robin 或 least_busy
+        'replica_policy': 'round_robin',
+        # 写入之后多少秒内该客户端的查询都读主库（读己之写）
+        'read_your_writes': 5,
+        # 相同的并发查询只执行一次
+        'single_flight': True
     },
     'session': {
-        'secret': 'PyBlog'
+        'secret': 'PyBlog',
+        'cache_size': 10000,
+        'cache_ttl': 300
+    },
+    'render': {
+        'cache_size': 256,
+        'workers': 2,
+        'timeout': 3.0,
+        'max_pending': 16
+    },
+    'templates': {
+        # 非 debug 模式下模版字节码缓存的目录，None 表示使用系统临时目录
+        'bytecode_cache': None,
+        # 使用 Jinja2 的异步模式边渲染边输出页面
+        'stream': False,
+        'stream_chunk_size': 4096
+    },
+    'page_cache': {
+        # 未登录访客的整页缓存
+        'maxsize': 500,
+        'ttl': 10,
+        'paths': ['/'],
+        'prefixes': ['/blog/']
+    },
+    'compress': {
+        # 小于 threshold 字节的响应不压缩，大于 offload_size 字节的响应在线程池中压缩
+        'threshold': 1024,
+        'offload_size': 65536,
+        'gzip_level': 6,
+        'brotli_quality': 5
+    },
+    'static': {
+        # 带内容摘要的文件缓存一年，其他文件缓存一小时
+        'max_age': 31536000,
+        'default_max_age': 3600
+    },
+    'json': {
+        # auto: 安装了 orjson 就使用 orjson，否则使用标准库 json
+        'encoder': 'auto'
     }
 }
\ No newline at end of file
@@ -7,10 +7,11 @@ __author__ = 'Victor Song'
 Web 框架
 '''
 
-import asyncio, functools, inspect, logging, os
+import asyncio, functools, inspect, logging, mimetypes, os
 from urllib import parse
 from aiohttp import web
 from apis import APIError
+import assets, compress
 
 def get(path):
     '''
@@ -133,9 +134,53 @@ class RequestHandler(object):
         except APIError as e:
             return dict(error=e.error, data=e.data, message=e.message)
 
+class StaticHandler(object):
+    '''
+    Serve static files, prefer the precompressed .br / .gz file built by assets.py
+    文件由这里读取输出，而不是交给 web.FileResponse：FileResponse 会自行查找 .gz / .br 文件，并且不处理 q 值
+    '''
+    def __init__(self, root, chunk_size: int = 65536):
+        self._root = os.path.realpath(root)
+        self._chunk_size = chunk_size
+    async def __call__(self, request: web.Request):
+        name = request.match_info['name']
+        path = os.path.realpath(os.path.join(self._root, name))
+        if not path.startswith(self._root + os.sep) or not os.path.isfile(path):
+            raise web.HTTPNotFound()
+        headers = {
+            'Cache-Control': assets.cache_control(name),
+            'Vary': 'Accept-Encoding'
+        }
+        st = os.stat(path)
+        if request.if_modified_since is not None and int(st.st_mtime) <= request.if_modified_since.timestamp():
+            return web.Response(status=304, headers=headers)
+        headers['Content-Type'] = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        candidates = [e for e in ('br', 'gzip') if os.path.isfile(path + ('.br' if 'br' == e else '.gz'))]
+        encoding = compress.negotiate(request.headers.get('Accept-Encoding'), candidates) if candidates else None
+        if encoding:
+            headers['Content-Encoding'] = encoding
+            path += '.br' if 'br' == encoding else '.gz'
+        resp = web.StreamResponse(headers=headers)
+        resp.last_modified = st.st_mtime
+        resp.content_length = os.path.getsize(path)
+        await resp.prepare(request)
+        if 'HEAD' == request.method:
+            await resp.write_eof()
+            return resp
+        loop = asyncio.get_event_loop()
+        with open(path, 'rb') as f:
+            while True:
+                chunk = await loop.run_in_executor(None, f.read, self._chunk_size)
+                if not chunk:
+                    break
+                await resp.write(chunk)
+        await resp.write_eof()
+        return resp
+
 def add_static(app):
-    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
-    app.router.add_static('/static/', path)
+    path = assets.static_root()
+    # add_get 同时注册 HEAD
+    app.router.add_get('/static/{name:.+}', StaticHandler(path))
     logging.info('add static %s => %s' % ('/static/', path))
     
 def add_route(app, func):
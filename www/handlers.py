@@ -9,14 +9,21 @@ URL handlers
 
 from aiohttp import web
 from coroweb import get, post
-from models import Blog, User, next_id, Comment
+from models import Blog, User, next_id, Comment, user_sessions
 from config import configs
-from apis import APIValueError, APIError, APIPermissionError, APIResourceNotFoundError, Page
-import asyncio, time, re, hashlib, json, logging
-import markdown2
+from apis import APIValueError, APIError, APIPermissionError, APIResourceNotFoundError, Page, Cursor
+import asyncio, time, re, hashlib, logging
+import orm, render, assets
+from serializer import dumps
+from cache import LRUCache
+from render import text2html
 
 COOKIE_NAME = 'pyblogsess'
 _COOKIE_KEY = configs.session.secret
+_COMMENTS_PAGE_SIZE = 20
+
+# 未登录访客的整页缓存: (path?query, 协商的压缩算法) ==> (body, headers)，同一页面的不同压缩版本分别缓存，博客和评论变化时清空
+page_cache = LRUCache(configs.page_cache.maxsize, configs.page_cache.ttl)
 
 def check_admin(request):
     if request.__user__ is None or not request.__user__.admin:
@@ -53,8 +60,13 @@ async def cookie2user(cookie_str: str):
         if 3 != len(l):
             return None
         uid, expires, sha1 = l
-        if int(expires) < time.time():
+        ttl = int(expires) - time.time()
+        if ttl < 0:
+            user_sessions.pop(cookie_str)
             return None
+        session = user_sessions.get(cookie_str)
+        if session is not None:
+            return User(**session)
         user = await User.find(uid)
         if user is None:
             return None
@@ -63,20 +75,17 @@ async def cookie2user(cookie_str: str):
             logging.info('invalid sha1')
             return None
         user.passwd = '******'
+        user_sessions.set(cookie_str, dict(user), min(ttl, configs.session.cache_ttl))
         return user
     except Exception as e:
         logging.exception(e)
         return None
 
-def text2html(text):
-    lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'), filter(lambda s: s.strip() != '', text.split('\n')))
-    return ''.join(lines)
-
 @get('/')
 async def index(*, page=1):
     page_index = get_page_index(page)
-    num = await Blog.find_number('count(id)')
-    page = Page(num)
+    num = await Blog.find_number('count(id)', cached=True)
+    page = Page(num, page_index)
     if num == 0:
         blogs = []
     else:
@@ -95,10 +104,11 @@ def register():
 
 @get('/api/users')
 async def api_get_users():
-    users = await User.findAll(orderBy='created_at desc')
-    for u in users:
-        u.passwd = '******'
-    return dict(users=users)
+    async def users():
+        async for u in User.iterate(orderBy='created_at desc'):
+            u.passwd = '******'
+            yield u
+    return dict(users=users())
 
 @get('/signin')
 def signin():
@@ -134,7 +144,12 @@ def manage_edit_blog(*, id):
 async def api_delete_blog(request, *, id):
     check_admin(request)
     blog = await Blog.find(id)
-    await blog.remove()
+    if blog is None:
+        raise APIResourceNotFoundError('Blog')
+    async with orm.transaction():
+        await blog.remove()
+        await Comment.remove_all('`blog_id`=?', [id])
+    page_cache.clear()
     return dict(id=id)
 
 @get('/manage/users')
@@ -168,31 +183,58 @@ async def authenticate(*, email, password):
     r.set_cookie(COOKIE_NAME, user2cookie(user), max_age=86400, httponly=True)
     user.passwd = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = dumps(user)
     return r
 
 @get('/blog/{id}')
-async def get_blog(id):
+async def get_blog(id, request):
     blog = await Blog.find(id)
-    comments = await Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
-    for c in comments:
-        c.html_content = text2html(c.content)
-    blog.html_content = markdown2.markdown(blog.content)
+    if blog is None:
+        raise APIResourceNotFoundError('Blog')
+    comments, cursor = await find_comments(id)
+    user = request.__user__
+    # 由页面用到的数据得到 ETag，客户端缓存有效时不需要渲染模版
+    # 发表时间显示为“3小时前”这样的相对时间，显示的文字变化时 ETag 也要变化
+    dates = [render.datetime_filter(t) for t in [blog.created_at] + [c.created_at for c in comments]]
+    etag = hashlib.sha1(repr((blog.id, render.content_digest(blog.content), blog.name, blog.user_id, blog.user_name, blog.user_image, [c.id for c in comments], cursor.next_cursor, dates, user and (user.id, user.name, user.image), assets.version)).encode('utf-8')).hexdigest()
+    if not blog.html_content:
+        blog.html_content = await render.markdown(blog.id, blog.content)
     return {
         '__template__': 'blog.html',
+        '__etag__': etag,
         'blog': blog,
-        'comments': comments
+        'comments': comments,
+        'cursor': cursor
     }
 
+async def find_comments(blog_id, cursor=''):
+    '''
+    Load one page of comments of blog, newest first.
+    '''
+    c = Cursor(cursor, _COMMENTS_PAGE_SIZE)
+    comments = c.trim(await Comment.findAll('blog_id=?', [blog_id], seek=c.seek, limit=c.limit))
+    for comment in comments:
+        comment.html_content = text2html(comment.content)
+    return comments, c
+
+@get('/api/blogs/{id}/comments')
+async def api_blog_comments(id, *, cursor=''):
+    comments, c = await find_comments(id, cursor)
+    return dict(cursor=c, comments=comments)
+
 @get('/api/blogs/{id}')
 async def api_get_blog(*, id):
     blog = await Blog.find(id)
     return blog
 
 @get('/api/blogs')
-async def api_blogs(*, page=1):
+async def api_blogs(*, page=1, cursor=None):
+    if cursor is not None:
+        c = Cursor(cursor)
+        blogs = await Blog.findAll(seek=c.seek, limit=c.limit)
+        return dict(cursor=c, blogs=c.trim(blogs))
     page_index = get_page_index(page)
-    num = await Blog.find_number('count(id)')
+    num = await Blog.find_number('count(id)', cached=True)
     p = Page(num, page_index)
     if 0 == num:
         return dict(page=p, blogs=())
@@ -228,12 +270,22 @@ async def api_create_blog(request, *, name: str, summary: str, content: str):
         raise APIValueError('cotent', 'content cannot be empty')
     blog = Blog(user_id=request.__user__.id, user_name=request.__user__.name, user_image=request.__user__.image, name=name.strip(), summary=summary.strip(), content=content.strip())
     await blog.save()
+    page_cache.clear()
     return blog
 
+@get('/api/stats/pool')
+def api_pool_stats(request):
+    check_admin(request)
+    return orm.pool_stats()
+
 @get('/api/comments')
-async def api_comments(*, page='1'):
+async def api_comments(*, page='1', cursor=None):
+    if cursor is not None:
+        c = Cursor(cursor)
+        comments = await Comment.findAll(seek=c.seek, limit=c.limit)
+        return dict(cursor=c, comments=c.trim(comments))
     page_index = get_page_index(page)
-    num = await Comment.find_number('count(id)')
+    num = await Comment.find_number('count(id)', cached=True)
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, comments=())
@@ -252,6 +304,7 @@ async def api_create_comment(id, request, *, content):
         raise APIResourceNotFoundError('Blog')
     comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content.strip(), reply_id=id)
     await comment.save()
+    page_cache.clear()
     return comment
 
 @post('/api/comments/{id}/delete')
@@ -261,6 +314,7 @@ async def api_delete_comments(id, request):
     if c is None:
         raise APIResourceNotFoundError('Comment')
     await c.remove()
+    page_cache.clear()
     return dict(id=id)
 
 @post('/api/users')
@@ -283,5 +337,5 @@ async def api_register_user(*, email, name, password):
     r.set_cookie(COOKIE_NAME, user2cookie(user), max_age=86400, httponly=True)
     user.passwd = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = dumps(user)
     return r
\ No newline at end of file
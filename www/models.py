@@ -8,15 +8,22 @@
 __author__ = 'Victor Song'
 
 import time, uuid
+import render
+from cache import LRUCache
+from config import configs
 from orm import Model, StringField, BooleanField, FloatField, TextField
 
 def next_id():
     ''' 随机生成 ID '''
     return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
 
+# cookie ==> 已验证的用户信息，用户被修改或删除时按用户 id 清除
+user_sessions = LRUCache(configs.session.cache_size, configs.session.cache_ttl)
+
 class User(Model):
     ''' 用户 '''
     __table__ = 'users'
+    __cache__ = dict(maxsize=1000, ttl=60)
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     email = StringField(ddl='varchar(50)')
     passwd = StringField(ddl='varchar(50)')
@@ -25,18 +32,51 @@ class User(Model):
     image = StringField(ddl='varchar(500)')
     created_at = FloatField(default=time.time)
 
+    @classmethod
+    def evict(cls, pk):
+        super().evict(pk)
+        prefix = '%s-' % pk
+        for key in user_sessions.keys():
+            if key.startswith(prefix):
+                user_sessions.pop(key)
+
 class Blog(Model):
     ''' 博客 '''
     __table__ = 'blogs'
+    __cache__ = dict(maxsize=200, ttl=60)
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     user_id = StringField(ddl='varchar(50)')
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
-    content = TextField()
+    content = TextField(deferred=True)
+    html_content = TextField(deferred=True)
     created_at = FloatField(default=time.time)
 
+    async def render_html(self):
+        ''' 在写入时把 Markdown 内容渲染成 HTML '''
+        self.html_content = await render.markdown(self.getValueOrDefault('id'), self.content, fallback=False)
+
+    async def save(self):
+        await self.render_html()
+        await super().save()
+
+    @classmethod
+    async def save_many(cls, blogs: list, chunk_size: int = 500):
+        for blog in blogs:
+            await blog.render_html()
+        return await super().save_many(blogs, chunk_size)
+
+    async def update(self):
+        if 'content' in self:
+            await self.render_html()
+        await super().update()
+
+    async def remove(self):
+        await super().remove()
+        render.invalidate(self.id)
+
 class Comment(Model):
     ''' 评论 '''
     __table__ = 'comments'
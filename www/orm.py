@@ -7,20 +7,43 @@ __author__ = 'Victor Song'
 关系对象映射
 '''
 
-import asyncio, logging
+import asyncio, logging, time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
 import aiomysql
+from cache import LRUCache
 
 def log(sql: str, args: tuple = ()):
     ''' 自定义 log '''
     logging.info('SQL: %s', sql)
 
-async def create_pool(loop, **kw):
-    ''' 创建 SQL 链接 '''
-    logging.info('create database connection pool...')
-    global __pool
-    __pool = await aiomysql.create_pool(
+# 获取连接耗时的统计区间（秒）
+ACQUIRE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+_acquire_timeout = None
+_metrics = dict(waiters=0, acquired=0, timeouts=0, acquire_seconds=0.0, histogram=[0] * (len(ACQUIRE_BUCKETS) + 1), coalesced=0)
+
+# 正在执行的查询：(路由, sql, 参数, size) ==> Task，相同的并发查询只执行一次
+_single_flight = True
+_inflight = dict()
+
+# 只读从库的连接池及选择策略：round_robin 轮流使用，least_busy 使用正在使用的连接最少的从库
+_replicas = []
+_replica_policy = 'round_robin'
+_next_replica = 0
+
+# 当前请求的读写状态，见 request_scope
+_scope = ContextVar('orm_scope', default=None)
+# 当前事务：使用的连接、事务中删除了缓存的对象，见 transaction
+_transaction = ContextVar('orm_transaction', default=None)
+
+async def _create_pool(loop, **kw):
+    return await aiomysql.create_pool(
         loop=loop,
-        maxsize=10,
+        minsize=kw.get('minsize', 1),
+        maxsize=kw.get('maxsize', 10),
+        pool_recycle=kw.get('pool_recycle', -1),
+        connect_timeout=kw.get('connect_timeout', 10),
         host=kw.get('host', 'localhost'),
         port=kw.get('port', 3306),
         user=kw['user'],
@@ -30,11 +53,185 @@ async def create_pool(loop, **kw):
         autocommit=kw.get('autocommit', True),
     )
 
+async def create_pool(loop, **kw):
+    ''' 创建 SQL 链接；replicas 中的每一项创建一个从库连接池，未指定的参数与主库相同 '''
+    logging.info('create database connection pool...')
+    global __pool, _replicas, _replica_policy, _acquire_timeout, _single_flight
+    _acquire_timeout = kw.get('acquire_timeout', None)
+    _single_flight = kw.get('single_flight', True)
+    _replica_policy = kw.get('replica_policy', 'round_robin')
+    __pool = await _create_pool(loop, **kw)
+    _replicas = []
+    for replica in kw.get('replicas', ()):
+        options = dict(kw, **replica)
+        logging.info('create replica connection pool: %s:%s...' % (options.get('host', 'localhost'), options.get('port', 3306)))
+        _replicas.append(await _create_pool(loop, **options))
+
+@contextmanager
+def request_scope(read_primary: bool = False):
+    ''' 记录一次请求的读写状态：写入之后，同一请求中的查询改读主库
+    read_primary 为 True 时整个请求都读主库，用于刚写入过数据的客户端（读己之写）
+    '''
+    scope = dict(read_primary=read_primary, written=False)
+    token = _scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _scope.reset(token)
+
+def _mark_written():
+    scope = _scope.get()
+    if scope is not None:
+        scope['written'] = scope['read_primary'] = True
+
+def _read_primary() -> bool:
+    scope = _scope.get()
+    return not _replicas or (scope is not None and scope['read_primary'])
+
+def _choose_pool(readonly: bool):
+    ''' 写入和需要读己之写的查询使用主库，其余查询按策略选择从库 '''
+    global __pool, _next_replica
+    if not readonly or _read_primary():
+        return __pool
+    # 每次从不同的从库开始，least_busy 在连接数相同时也能轮流使用
+    _next_replica = (_next_replica + 1) % len(_replicas)
+    candidates = _replicas[_next_replica:] + _replicas[:_next_replica]
+    if 'least_busy' == _replica_policy:
+        return min(candidates, key=lambda pool: pool.size - pool.freesize)
+    return candidates[0]
+
+@asynccontextmanager
+async def connection(readonly: bool = False):
+    ''' 从连接池获取连接，超过 acquire_timeout 秒拿不到连接时抛出 asyncio.TimeoutError
+    readonly 为 True 时可能使用从库；在事务中时使用事务的连接
+    '''
+    current = _transaction.get()
+    if current is not None:
+        yield current['connection']
+        return
+    pool = _choose_pool(readonly)
+    start = time.time()
+    _metrics['waiters'] += 1
+    try:
+        connect = await asyncio.wait_for(pool.acquire(), _acquire_timeout)
+    except asyncio.TimeoutError:
+        _metrics['timeouts'] += 1
+        logging.error('acquire database connection timeout: %s' % pool_stats())
+        raise
+    finally:
+        _metrics['waiters'] -= 1
+    elapsed = time.time() - start
+    _metrics['acquired'] += 1
+    _metrics['acquire_seconds'] += elapsed
+    _metrics['histogram'][next((i for i, b in enumerate(ACQUIRE_BUCKETS) if elapsed <= b), len(ACQUIRE_BUCKETS))] += 1
+    try:
+        yield connect
+    finally:
+        pool.release(connect)
+
+def _pool_size(pool) -> dict:
+    return dict(
+        size=pool.size,
+        in_use=pool.size - pool.freesize,
+        idle=pool.freesize,
+        minsize=pool.minsize,
+        maxsize=pool.maxsize
+    )
+
+def pool_stats() -> dict:
+    ''' 连接池的使用情况和获取连接的耗时分布，replicas 为各从库连接池的使用情况 '''
+    global __pool
+    acquired = _metrics['acquired']
+    stats = _pool_size(__pool)
+    stats.update(
+        waiters=_metrics['waiters'],
+        acquired=acquired,
+        timeouts=_metrics['timeouts'],
+        acquire_avg=_metrics['acquire_seconds'] / acquired if acquired else 0.0,
+        acquire_histogram=dict(zip(['<=%s' % b for b in ACQUIRE_BUCKETS] + ['>%s' % ACQUIRE_BUCKETS[-1]], _metrics['histogram'])),
+        coalesced=_metrics['coalesced']
+    )
+    if _replicas:
+        stats['replicas'] = [_pool_size(pool) for pool in _replicas]
+    return stats
+
+def has_replicas() -> bool:
+    return bool(_replicas)
+
+def in_transaction() -> bool:
+    return _transaction.get() is not None
+
+def _cacheable() -> bool:
+    ''' 只缓存从主库读到的已提交的记录：从库可能还没有同步刚写入的数据，事务中的写入可能回滚 '''
+    return _read_primary() and not in_transaction()
+
+@asynccontextmanager
+async def transaction():
+    ''' 在同一个连接上执行事务，正常退出时提交，出现异常时回滚
+    事务中的 select、execute 以及 Model 的读写都使用该连接；嵌套使用时加入外层事务
+    同一个连接不能并发执行查询，事务中不要使用 asyncio.gather 等并发执行数据库操作
+
+        async with orm.transaction():
+            await blog.remove()
+            await orm.execute('delete from comments where blog_id=?', [blog.id])
+    '''
+    current = _transaction.get()
+    if current is not None:
+        yield current['connection']
+        return
+    _mark_written()
+    async with connection() as connect:
+        current = dict(connection=connect, evicted=[])
+        token = _transaction.set(current)
+        try:
+            await connect.begin()
+            yield connect
+            await connect.commit()
+        except BaseException as e:
+            await connect.rollback()
+            logging.error('rollback transaction: %s' % e)
+            # 事务中对计数缓存的修改没有生效
+            for cls, pk in current['evicted']:
+                cls.__counter__['value'] = None
+            raise
+        finally:
+            _transaction.reset(token)
+            # 提交或回滚之前，其他请求可能又把旧数据写入了缓存
+            for cls, pk in current['evicted']:
+                cls.evict(pk)
+
 async def select(sql: str, args, size: int=None):
-    ''' 查询语句 '''
+    ''' 查询语句，相同的并发查询（如缓存过期后同一篇博客的大量请求）只执行一次，结果复制给每个调用方
+    在事务中或者当前请求写入过数据时不合并，保证能读到自己的写入
+    '''
+    scope = _scope.get()
+    if not _single_flight or in_transaction() or (scope is not None and scope['written']):
+        return await _select(sql, args, size)
+    key = ('primary' if _read_primary() else 'replica', sql, tuple(args or ()), size)
+    try:
+        task = _inflight.get(key)
+    except TypeError:
+        # 参数不可哈希
+        return await _select(sql, args, size)
+    if task is None:
+        task = asyncio.ensure_future(_select(sql, args, size))
+        _inflight[key] = task
+        def done(t):
+            _inflight.pop(key, None)
+            # 所有调用方都已取消时，避免 Task exception was never retrieved
+            if not t.cancelled():
+                t.exception()
+        task.add_done_callback(done)
+    else:
+        _metrics['coalesced'] += 1
+        logging.info('SQL (coalesced): %s', sql)
+    # 调用方被取消时不影响其他等待同一查询的调用方
+    result = await asyncio.shield(task)
+    return [dict(r) for r in result]
+
+async def _select(sql: str, args, size: int=None):
     log(sql, args=args)
-    global __pool
-    async with __pool.get() as connect:
+    async with connection(readonly=True) as connect:
         async with connect.cursor(aiomysql.DictCursor) as cursor:
             await cursor.execute(sql.replace('?', '%s'), args or ())
             if size:
@@ -44,25 +241,43 @@ async def select(sql: str, args, size: int=None):
             logging.info('rows returned: %s', len(result))
         return result
 
+async def select_iter(sql: str, args, batch_size: int = 500):
+    ''' 使用服务端游标的查询语句，逐行返回结果 '''
+    log(sql, args=args)
+    async with connection(readonly=True) as connect:
+        async with connect.cursor(aiomysql.SSDictCursor) as cursor:
+            await cursor.execute(sql.replace('?', '%s'), args or ())
+            while True:
+                rows = await cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for r in rows:
+                    yield r
+
 async def execute(sql: str, args, autocommit: bool = True):
-    ''' 执行增删改语句 '''
-    global __pool
-    async with __pool.get() as connect:
-        if not autocommit:
-            connect.begin()
+    ''' 执行增删改语句，autocommit 为 False 时在单独的事务中执行；已经在事务中时都加入当前事务 '''
+    _mark_written()
+    async with (connection() if autocommit else transaction()) as connect:
         try:
             async with connect.cursor(aiomysql.DictCursor) as cursor:
                 await cursor.execute(sql.replace('?', '%s'), args or ())
                 affected = cursor.rowcount
-            if not autocommit:
-                connect.commit()
         except BaseException as e:
-            if not autocommit:
-                await connect.rollback()
             logging.error(e)
             raise e
         return affected
 
+async def execute_many(sql: str, args_list: list, chunk_size: int = 500):
+    ''' 在一个事务中分批执行增删改语句，已经在事务中时加入当前事务 '''
+    log(sql)
+    affected = 0
+    async with transaction() as connect:
+        async with connect.cursor(aiomysql.DictCursor) as cursor:
+            for i in range(0, len(args_list), chunk_size):
+                await cursor.executemany(sql.replace('?', '%s'), args_list[i:i + chunk_size])
+                affected += cursor.rowcount
+    return affected
+
 class Field(object):
     ''' 各种字段的父类 
     Attributes:
@@ -70,13 +285,15 @@ class Field(object):
         column_type: 列的类型
         primary_key: 主键
         default: 默认值
+        deferred: 延迟加载，findAll 默认不查询该字段
     '''
-    def __init__(self, name: str, column_type: str, primary_key: bool, default):
+    def __init__(self, name: str, column_type: str, primary_key: bool, default, deferred: bool = False):
         ''' 初始化方法 '''
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default
+        self.deferred = deferred
     def __str__(self):
         return '<%s, %s:%s>' % (self.__class__.__name__, self.column_type, self.name)
 
@@ -102,8 +319,8 @@ class FloatField(Field):
 
 class TextField(Field):
     ''' Text 类型 '''
-    def __init__(self, name: str = None, default=None):
-        super().__init__(name, 'text', False, default)
+    def __init__(self, name: str = None, default=None, deferred: bool = False):
+        super().__init__(name, 'text', False, default, deferred)
 
 def create_args_strings(num: int):
     ''' 创建 SQL 参数字符串 '''
@@ -112,6 +329,36 @@ def create_args_strings(num: int):
         l.append('?')
     return ', '.join(l)
 
+# 表名 ==> Model 类
+_models = dict()
+# 缓存删除的监听函数 fn(table, pk)，多进程部署时用于通知其他 worker，见 supervisor.py
+_evict_listeners = []
+_evicting_remote = False
+
+def add_evict_listener(fn):
+    _evict_listeners.append(fn)
+
+def _notify_evict(cls, pk):
+    if not _evicting_remote:
+        for fn in _evict_listeners:
+            fn(cls.__table__, pk)
+
+def evict_remote(table: str, pk=None):
+    ''' 删除其他进程中的写入导致过期的缓存：按主键缓存的记录（pk 为 None 时全部删除）和计数缓存 '''
+    global _evicting_remote
+    cls = _models.get(table)
+    if cls is None:
+        return
+    _evicting_remote = True
+    try:
+        if pk is not None:
+            cls.evict(pk)
+        elif cls.__identity_cache__ is not None:
+            cls.__identity_cache__.clear()
+        cls.__counter__['value'] = None
+    finally:
+        _evicting_remote = False
+
 class ModelMetaclass(type):
     ''' 所有 Model 类的创建魔术代码，用于定义各个 Model 的数据库操作属性 '''
     def __new__(cls, name, bases, attrs):
@@ -141,13 +388,22 @@ class ModelMetaclass(type):
         attrs['__table__'] = table_name
         attrs['__primary_key__'] = primaty_key
         attrs['__fields__'] = fields
+        attrs['__deferred__'] = [f for f in fields if mapping[f].deferred]
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaty_key, ', '.join(escaped_fields), table_name)
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (table_name, ', '.join(escaped_fields), primaty_key, create_args_strings(len(fields) + 1))
         attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (table_name, ', '.join(map(lambda f: '%s=?' % (mapping.get(f).name or f), fields)), primaty_key)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (table_name, primaty_key)
-        return type.__new__(cls, name, bases, attrs)
+        # 按主键缓存查询结果，如 __cache__ = dict(maxsize=1000, ttl=60)
+        cache_options = attrs.get('__cache__', None)
+        attrs['__identity_cache__'] = LRUCache(**cache_options) if cache_options else None
+        # 整表行数的计数缓存，由 save/remove 增减，超过 __counter_ttl__ 秒后重新查询
+        attrs['__counter__'] = dict(value=None, at=0)
+        model = type.__new__(cls, name, bases, attrs)
+        _models[table_name] = model
+        return model
 
 class Model(dict, metaclass=ModelMetaclass):
+    __counter_ttl__ = 60
     def __init__(self, **kw):
         super().__init__(**kw)
     def __getattr__(self, key):
@@ -169,15 +425,37 @@ class Model(dict, metaclass=ModelMetaclass):
                 setattr(self, key, value)
         return value
     @classmethod
-    async def findAll(cls, where=None, args=None, **kw):
-        ''' find object by where clause. '''
-        sql = [cls.__select__]
-        if where:
-            sql.append('where ')
-            sql.append(where)
+    def select_fields(cls, fields=None):
+        ''' 生成只查询部分字段的 select 语句，fields 为 None 时查询所有非延迟加载的字段 '''
+        if fields is None:
+            if not cls.__deferred__:
+                return cls.__select__
+            fields = [f for f in cls.__fields__ if f not in cls.__deferred__]
+        for f in fields:
+            if f not in cls.__mapping__:
+                raise ValueError('Invalid field: %s' % f)
+        fields = [f for f in fields if f != cls.__primary_key__]
+        return 'select %s from `%s`' % (', '.join(map(lambda f: '`%s`' % f, [cls.__primary_key__] + fields)), cls.__table__)
+
+    @classmethod
+    def build_select(cls, where=None, args=None, **kw):
+        ''' 生成 findAll / iterate 的查询语句和参数 '''
+        sql = [cls.select_fields(kw.get('fields', None))]
         if not args:
             args = []
         order_by = kw.get('orderBy', None)
+        if 'seek' in kw:
+            # keyset 分页：按 (seekBy desc, 主键 desc) 排序，seek 为上一页最后一行的 (seekBy 的值, 主键)
+            column = kw.get('seekBy', 'created_at')
+            order_by = '`%s` desc, `%s` desc' % (column, cls.__primary_key__)
+            seek = kw['seek']
+            if seek is not None:
+                seek_where = '(`%s` < ? or (`%s` = ? and `%s` < ?))' % (column, column, cls.__primary_key__)
+                where = '(%s) and %s' % (where, seek_where) if where else seek_where
+                args = list(args) + [seek[0], seek[0], seek[1]]
+        if where:
+            sql.append('where ')
+            sql.append(where)
         if order_by:
             sql.append('order by ')
             sql.append(order_by)
@@ -186,52 +464,172 @@ class Model(dict, metaclass=ModelMetaclass):
             sql.append('limit')
             if isinstance(limit, int):
                 sql.append('?')
-                sql.append(limit)
+                args.append(limit)
             elif isinstance(limit, tuple) and 2 == len(limit):
                 sql.append('?,?')
                 args.extend(limit)
             else:
                 raise ValueError('Invalid limit value: %s' % str(limit))
-        result = await select(' '.join(sql), args)
+        return ' '.join(sql), args
+
+    @classmethod
+    async def findAll(cls, where=None, args=None, **kw):
+        ''' find object by where clause. fields: 只查询指定的字段 '''
+        sql, args = cls.build_select(where, args, **kw)
+        result = await select(sql, args)
         return [cls(**r) for r in result]
+
     @classmethod
-    async def find_number(cls, selectField, where=None, args=None):
-        ''' find number by select and where. '''
-        sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        result = await select(' '.join(sql), args, 1)
+    async def iterate(cls, where=None, args=None, batch_size: int = 500, **kw):
+        ''' 同 findAll，但使用服务端游标逐个返回对象，内存占用不随结果集增长 '''
+        sql, args = cls.build_select(where, args, **kw)
+        async for r in select_iter(sql, args, batch_size):
+            yield cls(**r)
+    @classmethod
+    async def find_number(cls, selectField, where=None, args=None, cached=False, estimate=False):
+        ''' find number by select and where.
+        cached: 整表计数时使用计数缓存
+        estimate: 整表计数时使用 information_schema 中的估算行数
+        '''
+        counter = cls.__counter__
+        counting = where is None and selectField.replace(' ', '').lower() in ('count(*)', 'count(%s)' % cls.__primary_key__)
+        if counting and cached and counter['value'] is not None and time.time() - counter['at'] < cls.__counter_ttl__:
+            return counter['value']
+        if counting and estimate:
+            result = await select('select table_rows _num_ from information_schema.tables where table_schema=database() and table_name=?', [cls.__table__], 1)
+        else:
+            sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
+            if where:
+                sql.append('where')
+                sql.append(where)
+            result = await select(' '.join(sql), args, 1)
         if 0 == len(result):
             return None
-        return result[0]['_num_']
+        num = result[0]['_num_']
+        if counting:
+            counter['value'], counter['at'] = num, time.time()
+        return num
 
     @classmethod
-    async def find(cls, pk):
-        ' find object by primary key '
+    async def find(cls, pk, fields=None):
+        ' find object by primary key, load all fields unless fields is given '
+        if fields is not None:
+            result = await select('%s where `%s`=?' % (cls.select_fields(fields), cls.__primary_key__), [pk], 1)
+            return cls(**result[0]) if result else None
+        cache = cls.__identity_cache__
+        if cache is not None:
+            row = cache.get(pk)
+            if row is not None:
+                return cls(**row)
         result = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
         if 0 == len(result):
             return None
+        if cache is not None and _cacheable():
+            cache.set(pk, dict(result[0]))
         return cls(**result[0])
 
+    async def load(self, *fields):
+        ' load deferred fields of this object, all of them if fields is empty '
+        fields = [f for f in (fields or self.__deferred__) if f not in self]
+        if not fields:
+            return self
+        pk = self.getValue(self.__primary_key__)
+        result = await select('%s where `%s`=?' % (self.select_fields(fields), self.__primary_key__), [pk], 1)
+        for k, v in (result[0] if result else {}).items():
+            self[k] = v
+        return self
+
+    @classmethod
+    async def find_many(cls, pks, chunk_size: int = 500):
+        ' find objects by primary keys, return dict of pk ==> object in the order of pks '
+        pks = list(dict.fromkeys(pks))
+        cache = cls.__identity_cache__
+        rows = dict()
+        missing = []
+        for pk in pks:
+            row = cache.get(pk) if cache is not None else None
+            if row is None:
+                missing.append(pk)
+            else:
+                rows[pk] = row
+        for i in range(0, len(missing), chunk_size):
+            chunk = missing[i:i + chunk_size]
+            result = await select('%s where `%s` in (%s)' % (cls.__select__, cls.__primary_key__, create_args_strings(len(chunk))), chunk)
+            for r in result:
+                rows[r[cls.__primary_key__]] = r
+                if cache is not None and _cacheable():
+                    cache.set(r[cls.__primary_key__], dict(r))
+        return {pk: cls(**rows[pk]) for pk in pks if pk in rows}
+
+    @classmethod
+    def evict(cls, pk):
+        ' drop cached row of primary key, again when the current transaction ends '
+        current = _transaction.get()
+        if current is not None:
+            current['evicted'].append((cls, pk))
+        if cls.__identity_cache__ is not None:
+            cls.__identity_cache__.pop(pk)
+        _notify_evict(cls, pk)
+
     async def save(self):
         ' Save object to database '
         args = list(map(self.getValueOrDefault, self.__fields__))
         args.append(self.getValueOrDefault(self.__primary_key__))
+        self.evict(args[-1])
         rows = await execute(self.__insert__, args)
         if 1 != rows:
             logging.warn('Failed to insert record: affected rows: %s' % rows)
+        elif self.__counter__['value'] is not None:
+            self.__counter__['value'] += 1
+    @classmethod
+    async def save_many(cls, models: list, chunk_size: int = 500):
+        ' Save objects to database with executemany in one transaction '
+        if not models:
+            return 0
+        args_list = []
+        for m in models:
+            args = list(map(m.getValueOrDefault, cls.__fields__))
+            args.append(m.getValueOrDefault(cls.__primary_key__))
+            args_list.append(args)
+            cls.evict(args[-1])
+        rows = await execute_many(cls.__insert__, args_list, chunk_size)
+        if len(models) != rows:
+            logging.warn('Failed to insert all records: affected rows: %s of %s' % (rows, len(models)))
+        if cls.__counter__['value'] is not None:
+            cls.__counter__['value'] += rows
+        return rows
     async def update(self):
-        ' update object to database '
-        args = list(map(self.getValue, self.__fields__))
+        ' update object to database, only fields loaded or set on this object are written '
+        # findAll(fields=[...]) 得到的对象只有部分字段，未加载的字段保持数据库中的值
+        fields = [f for f in self.__fields__ if f in self]
+        if not fields:
+            logging.warn('Nothing to update for primary key: %s' % self.getValue(self.__primary_key__))
+            return
+        sql = self.__update__
+        if len(fields) != len(self.__fields__):
+            sql = 'update `%s` set %s where `%s`=?' % (self.__table__, ', '.join(map(lambda f: '`%s`=?' % (self.__mapping__.get(f).name or f), fields)), self.__primary_key__)
+        args = list(map(self.getValue, fields))
         args.append(self.getValue(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        rows = await execute(sql, args)
+        self.evict(args[-1])
         if 1 != rows:
             logging.warn('Failed to update by primary key: affected rows: %s' % rows)
+    @classmethod
+    async def remove_all(cls, where, args=None):
+        ' delete objects by where, return affected rows '
+        rows = await execute('delete from `%s` where %s' % (cls.__table__, where), args)
+        if cls.__identity_cache__ is not None:
+            cls.__identity_cache__.clear()
+        cls.__counter__['value'] = None
+        _notify_evict(cls, None)
+        return rows
     async def remove(self):
         ' delete object from database '
         args = [self.getValue(self.__primary_key__)]
         rows = await execute(self.__delete__, args)
+        self.evict(args[0])
         if 1 != rows:
             logging.warn('Failed to remove by primary key: affeted rows:%s' % rows)
+        elif self.__counter__['value'] is not None:
+            self.__counter__['value'] -= 1
 
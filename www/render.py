@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Victor Song'
+
+'''
+Markdown 渲染及渲染结果缓存，以及模版中使用的文本格式化
+'''
+
+import asyncio, hashlib, logging, time
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import markdown2
+from cache import LRUCache
+from config import configs
+
+# blog id ==> (内容摘要, 渲染后的 HTML)
+_html_cache = LRUCache(configs.render.cache_size)
+
+_executor = None
+_pending = 0
+
+def init_pool(workers: int = None):
+    ''' 创建渲染进程池 '''
+    global _executor
+    workers = workers or configs.render.workers
+    logging.info('create markdown render pool (workers: %s)...' % workers)
+    _executor = ProcessPoolExecutor(max_workers=workers)
+
+async def close_pool(app=None):
+    ''' 关闭渲染进程池，可以直接作为 app.on_cleanup 的回调 '''
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+
+def text2html(text):
+    lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'), filter(lambda s: s.strip() != '', text.split('\n')))
+    return ''.join(lines)
+
+def datetime_filter(t):
+    delta = int(time.time() - t)
+    if delta < 60:
+        return u'1分钟前'
+    if delta < 3600:
+        return u'%s分钟前' % (delta // 60)
+    if delta < 86400:
+        return u'%s小时前' % (delta // 3600)
+    if delta < 604800:
+        return u'%s天前' % (delta // 86400)
+    dt = datetime.fromtimestamp(t)
+    return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
+
+def content_digest(content: str) -> str:
+    ''' 计算内容摘要 '''
+    return hashlib.sha1((content or '').encode('utf-8')).hexdigest()
+
+def _submit(blog_id: str, digest: str, content: str):
+    ''' 把渲染任务交给进程池，完成后写入缓存（即使调用方已经超时） '''
+    global _pending
+    _pending += 1
+    future = asyncio.get_event_loop().run_in_executor(_executor, markdown2.markdown, content)
+    def done(f):
+        global _pending
+        _pending -= 1
+        if not f.cancelled() and f.exception() is None:
+            _html_cache.set(blog_id, (digest, f.result()))
+    future.add_done_callback(done)
+    return future
+
+async def markdown(blog_id: str, content: str, fallback: bool = True) -> str:
+    ''' 渲染博客内容，同一版本的内容只渲染一次
+    fallback 为 True 时，进程池繁忙或渲染超时会退化为纯文本渲染
+    '''
+    content = content or ''
+    digest = content_digest(content)
+    cached = _html_cache.get(blog_id)
+    if cached is not None and cached[0] == digest:
+        return cached[1]
+    logging.info('render markdown for blog: %s' % blog_id)
+    if _executor is None:
+        html = markdown2.markdown(content)
+        _html_cache.set(blog_id, (digest, html))
+        return html
+    if fallback and _pending >= configs.render.max_pending:
+        logging.warning('render pool saturated, fallback to text for blog: %s' % blog_id)
+        return text2html(content)
+    future = _submit(blog_id, digest, content)
+    if not fallback:
+        return await future
+    try:
+        return await asyncio.wait_for(asyncio.shield(future), configs.render.timeout)
+    except asyncio.TimeoutError:
+        logging.warning('render timeout, fallback to text for blog: %s' % blog_id)
+        return text2html(content)
+
+def invalidate(blog_id: str):
+    ''' 删除博客的渲染缓存 '''
+    _html_cache.pop(blog_id)
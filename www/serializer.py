@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Victor Song'
+
+'''
+JSON 序列化，安装了 orjson 时优先使用 orjson
+'''
+
+import json, logging
+from config import configs
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def default(o):
+    ''' 编码 Page、Cursor 等普通对象（Model 本身就是 dict，不需要处理），定义了 __json__ 的对象只输出其返回值 '''
+    if hasattr(o, '__json__'):
+        return o.__json__()
+    if hasattr(o, '__dict__'):
+        return o.__dict__
+    if isinstance(o, (set, tuple)):
+        return list(o)
+    raise TypeError('Object of type %s is not JSON serializable' % o.__class__.__name__)
+
+def std_dumps(o) -> bytes:
+    return json.dumps(o, ensure_ascii=False, default=default).encode('utf-8')
+
+def orjson_dumps(o) -> bytes:
+    return orjson.dumps(o, default=default)
+
+def get_encoder(name: str = 'auto'):
+    ''' 按名称选择编码函数: auto, orjson, json '''
+    if name in ('auto', 'orjson') and orjson is not None:
+        return orjson_dumps
+    if 'orjson' == name:
+        logging.warning('orjson is not installed, fallback to json.')
+    return std_dumps
+
+dumps = get_encoder(configs.json.encoder)
+logging.info('json encoder: %s' % dumps.__name__)
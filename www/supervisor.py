@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Victor Song'
+
+'''
+多进程启动服务：每个 worker 有自己的事件循环和数据库连接池，通过 SO_REUSEPORT 共享同一个端口
+
+用法: python3 supervisor.py [worker 数量]
+    kill -HUP <pid>   逐个重启 worker（新 worker 开始报告状态后才停止旧 worker）
+    kill -TERM <pid>  停止所有 worker 并退出
+
+每个 worker 有自己的页面缓存、按主键缓存的记录、登录状态缓存和计数缓存。worker 删除缓存时通知 supervisor，
+由 supervisor 转发给其他 worker，通常在几毫秒内生效；其他 worker 在转发到达之前（或写入的事务提交之前）
+读到的旧数据最多保留到缓存过期（见 Model.__cache__ 和 configs.session.cache_ttl）
+'''
+
+import logging; logging.basicConfig(level=logging.INFO)
+import multiprocessing, os, queue, signal, sys, time
+from config import configs
+
+def run_worker(health, inbox):
+    ''' worker 进程入口 '''
+    import app
+    app.start_server(reuse_port=True, health=health, inbox=inbox)
+
+class Supervisor(object):
+    ''' 管理 worker 进程
+    Attributes:
+        size: worker 数量
+        workers: pid ==> worker 信息（进程、启动时间、最近一次报告的状态、接收缓存删除通知的队列）
+    '''
+    def __init__(self, size: int):
+        self.size = size
+        self.workers = dict()
+        # 使用 spawn，重启后的 worker 会重新导入磁盘上的代码
+        self._context = multiprocessing.get_context('spawn')
+        self._health = self._context.Queue()
+        self._stopping = False
+        self._restarting = False
+        self._reported_at = 0
+
+    def spawn(self):
+        inbox = self._context.Queue()
+        process = self._context.Process(target=run_worker, args=(self._health, inbox))
+        process.start()
+        self.workers[process.pid] = dict(process=process, started_at=time.time(), health=None, inbox=inbox)
+        logging.info('start worker [%s]' % process.pid)
+        return process.pid
+
+    def remove_worker(self, pid: int):
+        ''' 不再向已经停止的 worker 转发通知 '''
+        worker = self.workers.pop(pid)
+        worker['inbox'].close()
+        # 队列中未读取的通知不需要送达，避免 supervisor 退出时等待
+        worker['inbox'].cancel_join_thread()
+        return worker
+
+    def stop_worker(self, pid: int, timeout: float = 10):
+        ''' 发送 SIGTERM，aiohttp 会处理完正在进行的请求再退出 '''
+        worker = self.remove_worker(pid)
+        process = worker['process']
+        process.terminate()
+        process.join(timeout)
+        if process.is_alive():
+            logging.warning('kill worker [%s]' % pid)
+            process.kill()
+            process.join()
+        logging.info('worker [%s] stopped with code %s' % (pid, process.exitcode))
+
+    def collect_health(self, timeout: float = 1):
+        ''' 读取 worker 报告的状态，把缓存删除通知转发给其他 worker '''
+        try:
+            report = self._health.get(timeout=timeout)
+            while True:
+                if 'evict' in report:
+                    for pid, worker in self.workers.items():
+                        if pid != report['pid']:
+                            worker['inbox'].put(report['evict'])
+                else:
+                    worker = self.workers.get(report['pid'])
+                    if worker is not None:
+                        worker['health'] = report
+                report = self._health.get_nowait()
+        except queue.Empty:
+            pass
+
+    def check_workers(self):
+        ''' 重启已经退出或者长时间没有报告状态的 worker '''
+        if self._stopping:
+            return
+        now = time.time()
+        for pid, worker in list(self.workers.items()):
+            process = worker['process']
+            if not process.is_alive():
+                logging.warning('worker [%s] exited with code %s' % (pid, process.exitcode))
+                self.remove_worker(pid)
+                self.spawn()
+                continue
+            last_seen = worker['health']['time'] if worker['health'] else worker['started_at']
+            if now - last_seen > configs.server.heartbeat_timeout:
+                logging.warning('worker [%s] not responding for %.0f seconds' % (pid, now - last_seen))
+                self.stop_worker(pid)
+                self.spawn()
+
+    def report(self):
+        ''' 定时输出各 worker 的状态 '''
+        now = time.time()
+        if now - self._reported_at < configs.server.heartbeat:
+            return
+        self._reported_at = now
+        for pid, worker in sorted(self.workers.items()):
+            health = worker['health']
+            if health is None:
+                logging.info('[supervisor] worker [%s] starting' % pid)
+            else:
+                stats = ', '.join('%s: %s' % (k, v) for k, v in sorted(health.items()) if k not in ('pid', 'time'))
+                logging.info('[supervisor] worker [%s] %.1fs ago, %s' % (pid, now - health['time'], stats))
+
+    def rolling_restart(self):
+        ''' 逐个替换 worker，期间始终有 worker 在监听端口 '''
+        logging.info('rolling restart %s workers...' % len(self.workers))
+        for old_pid in list(self.workers.keys()):
+            new_pid = self.spawn()
+            deadline = time.time() + configs.server.heartbeat_timeout
+            while not self._stopping and self.workers[new_pid]['health'] is None and time.time() < deadline:
+                self.collect_health()
+                if not self.workers[new_pid]['process'].is_alive():
+                    break
+            if self.workers[new_pid]['health'] is None:
+                logging.error('worker [%s] failed to start, abort rolling restart' % new_pid)
+                return
+            self.stop_worker(old_pid)
+        logging.info('rolling restart finished.')
+
+    def run(self):
+        def stop(signum, frame):
+            self._stopping = True
+        def restart(signum, frame):
+            self._restarting = True
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGHUP, restart)
+        logging.info('supervisor [%s] start %s workers on port %s...' % (os.getpid(), self.size, configs.server.port))
+        for _ in range(self.size):
+            self.spawn()
+        while not self._stopping:
+            self.collect_health()
+            if self._restarting:
+                self._restarting = False
+                self.rolling_restart()
+            self.check_workers()
+            self.report()
+        logging.info('stopping workers...')
+        for pid in list(self.workers.keys()):
+            self.stop_worker(pid)
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else configs.server.workers
+    Supervisor(size or os.cpu_count()).run()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+比较 JSON 编码器在各接口返回数据上的性能
+'''
+
+__author__ = 'Victor Song'
+
+import sys
+
+sys.path.append('../')
+
+import timeit
+import serializer
+from apis import Page, Cursor
+from models import User, Blog, Comment, next_id
+
+def make_payloads():
+    blogs = [Blog(id=next_id(), user_id=next_id(), user_name='测试用户', user_image='about:blank', name='博客标题 %s' % i, summary='摘要' * 50, created_at=1577808000.0 + i) for i in range(10)]
+    comments = [Comment(id=next_id(), blog_id=next_id(), reply_id='', user_id=next_id(), user_name='测试用户', user_image='about:blank', content='评论内容' * 40, created_at=1577808000.0 + i) for i in range(10)]
+    users = [User(id=next_id(), email='test%s@example.com' % i, passwd='******', admin=False, name='用户 %s' % i, image='about:blank', created_at=1577808000.0 + i) for i in range(1000)]
+    blog = Blog(**blogs[0], content='# 标题\n\n' + '正文内容 ' * 2000)
+    return {
+        'api_blogs': dict(page=Page(100, 2), blogs=blogs),
+        'api_blogs (cursor)': dict(cursor=Cursor(), blogs=blogs),
+        'api_comments': dict(page=Page(1000, 3), comments=comments),
+        'api_get_blog': blog,
+        'api_get_users': dict(users=users),
+    }
+
+def bench(number: int = 2000):
+    encoders = [('json', serializer.std_dumps)]
+    if serializer.orjson is not None:
+        encoders.append(('orjson', serializer.orjson_dumps))
+    for name, payload in make_payloads().items():
+        n = number // 100 if 'api_get_users' == name else number
+        results = []
+        for encoder_name, encoder in encoders:
+            t = timeit.timeit(lambda: encoder(payload), number=n)
+            results.append('%s: %.1f us' % (encoder_name, t / n * 1e6))
+        print('%-20s %s' % (name, ', '.join(results)))
+
+if __name__ == '__main__':
+    bench()